@@ -1,47 +1,124 @@
-from fastapi import FastAPI, HTTPException, File, UploadFile
-from sqlalchemy import create_engine, Column, Integer, String, text
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, File, UploadFile, Depends, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import BigInteger, Column, Integer, String, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from dotenv import load_dotenv
-import pandas as pd
+from cachetools import TTLCache
+import csv
+import io
+import atexit
 import os
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 from model import UserCreate
 
 # Load environment variables from a .env file
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(
-    filename='test.log',  
-    level=logging.INFO,   
-    format="%(asctime)s - %(levelname)s - %(message)s"
-)
+# Configure logging; records are queued and written to disk by a background listener thread
+log_queue = queue.SimpleQueue()
+file_handler = logging.FileHandler('test.log')
+file_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+log_listener = QueueListener(log_queue, file_handler)
+queue_handler = QueueHandler(log_queue)
+queue_handler.setFormatter(logging.Formatter("%(message)s"))  # Leave the full format to file_handler
+logging.getLogger().addHandler(queue_handler)
+logging.getLogger().setLevel(logging.INFO)
+log_listener.start()
+atexit.register(log_listener.stop)  # Flush queued records to disk on interpreter exit
+logger = logging.getLogger(__name__)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create tables in the database before serving requests when INIT_DB=1."""
+    if os.getenv('INIT_DB') == '1':
+        async with engine.begin() as conn:
+            # Workers start together; serialize their DDL so only the first one creates tables
+            await conn.execute(LOCK_SCHEMA_INIT)
+            await conn.run_sync(Base.metadata.create_all)
+    try:
+        yield
+    finally:
+        await engine.dispose()
 
 app = FastAPI(
     title="Test API",  # API title
     description="Pegatron Exam",  # API description
     version="1.0.0",  # API version
+    default_response_class=ORJSONResponse,  # Serialize responses with orjson
+    lifespan=lifespan,
 )
 
 # Database configuration
 DATABASE_URL = os.getenv('POSTGRESQL')
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+engine = create_async_engine(
+    make_url(DATABASE_URL).set(drivername="postgresql+asyncpg"),  # Use the asyncpg driver whatever the URL names
+    # Pools are per uvicorn worker; keep workers * (pool_size + max_overflow) under Postgres max_connections
+    pool_size=int(os.getenv('DB_POOL_SIZE', '5')),
+    max_overflow=int(os.getenv('DB_MAX_OVERFLOW', '5')),
+    pool_recycle=3600,
+    pool_pre_ping=True,
+)
+AsyncSessionLocal = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 Base = declarative_base()
 
+async def get_db():
+    """Provide a database session for the duration of a request."""
+    async with AsyncSessionLocal() as db:
+        yield db
+
 class User(Base):
     """SQLAlchemy model for the 'users' table."""
     __tablename__ = "users"
-    id = Column(Integer, primary_key=True, index=True)
-    name = Column(String, unique=True, index=True)
+    id = Column(Integer, primary_key=True)  # Already indexed by the primary key constraint
+    name = Column(String, unique=True, index=True)  # Unique index backs ON CONFLICT and name lookups
     age = Column(Integer)
 
-# Create tables in the database
-Base.metadata.create_all(bind=engine)
+class UsersVersion(Base):
+    """SQLAlchemy model for the single-row 'users_version' counter, bumped by every write to 'users'."""
+    __tablename__ = "users_version"
+    id = Column(Integer, primary_key=True)
+    version = Column(BigInteger, nullable=False)
+
+# Short-lived cache for the average age aggregate, cleared whenever users change
+avg_age_cache = TTLCache(maxsize=1, ttl=5)
+avg_age_generation = 0  # Bumped on every invalidation so reads that raced a write do not cache their result
+
+def invalidate_avg_age_cache():
+    """Drop the cached average age aggregate after a committed write to users."""
+    global avg_age_generation
+    avg_age_generation += 1
+    avg_age_cache.clear()
+
+# SQL statements, built once at import time and reused by every request
+LOCK_SCHEMA_INIT = text("SELECT pg_advisory_xact_lock(7243101)")  # Arbitrary app-wide lock key
+INSERT_USER = text(
+    "INSERT INTO users (name, age) VALUES (:name, :age) ON CONFLICT (name) DO NOTHING RETURNING id"
+)
+DELETE_USER = text("DELETE FROM users WHERE name = :name RETURNING id")
+SELECT_ALL_USERS = text("SELECT id, name, age FROM users")
+SELECT_USERS_VERSION = text("SELECT version FROM users_version WHERE id = 1")
+BUMP_USERS_VERSION = text(
+    "INSERT INTO users_version (id, version) VALUES (1, 1) "
+    "ON CONFLICT (id) DO UPDATE SET version = users_version.version + 1"
+)
+SELECT_AVERAGE_AGE_BY_GROUP = text(
+    "SELECT UPPER(LEFT(name, 1)) AS grp, AVG(age)::float AS avg_age FROM users GROUP BY 1"
+)
+CREATE_USERS_STAGE = text("CREATE TEMP TABLE users_stage (name text, age int) ON COMMIT DROP")
+MERGE_USERS_STAGE = text(
+    "INSERT INTO users (name, age) SELECT name, age FROM users_stage "
+    "WHERE name <> '' AND age <= 120 ON CONFLICT (name) DO NOTHING"
+)
 
 @app.post("/users/")
-def create_user(data: UserCreate):
+async def create_user(data: UserCreate, db: AsyncSession = Depends(get_db)):
     """
     Create a new user.
     
@@ -56,7 +133,6 @@ def create_user(data: UserCreate):
     Returns:
     - A message indicating the creation status of the user.
     """
-    db = SessionLocal()
     try:
         # Check if the user name is empty
         if not data.name:
@@ -66,36 +142,29 @@ def create_user(data: UserCreate):
         if data.age > 120:
             raise HTTPException(status_code=400, detail="User age cannot exceed 120 years")
 
-        # Check if the user already exists
-        query = text("SELECT * FROM users WHERE name = :name")
-        result = db.execute(query, {"name": data.name}).fetchone()
+        async with db.begin():
+            # Create new user; no id is returned if the name is already taken
+            result = await db.execute(INSERT_USER, {"name": data.name, "age": data.age})
         
-        if result:
-            raise HTTPException(status_code=400, detail="User already exists")
+            if result.fetchone() is None:
+                raise HTTPException(status_code=400, detail="User already exists")
+            await db.execute(BUMP_USERS_VERSION)
+        invalidate_avg_age_cache()
         
-        # Create new user
-        new_user = User(name=data.name, age=data.age)
-        db.add(new_user)
-        db.commit()
-        db.refresh(new_user)
-        
-        logging.info(f"User '{data.name}' created successfully")
+        logger.info("User '%s' created successfully", data.name)
         return {"detail": f"User '{data.name}' created successfully"}
     
     except HTTPException as http_exc:
         # Specific exception handling for HTTPException
-        logging.error(f"HTTPException: {str(http_exc.detail)}")
+        logger.error("HTTPException: %s", http_exc.detail)
         raise http_exc  # Re-raise the HTTPException to preserve the status code
     
     except Exception as e:
-        logging.error(f"Error creating user: {str(e)}")
+        logger.error("Error creating user: %s", e)
         raise HTTPException(status_code=500, detail="Internal server error")
-    
-    finally:
-        db.close()
 
-@app.delete("/users/{name}")
-def delete_user(name: str):
+@app.delete("/users/{name}", status_code=204)
+async def delete_user(name: str, db: AsyncSession = Depends(get_db)):
     """
     Delete a user by name.
     
@@ -106,100 +175,108 @@ def delete_user(name: str):
     - HTTPException: 404 if the user is not found.
     
     Returns:
-    - A detail message confirming the deletion.
+    - An empty 204 No Content response confirming the deletion.
     """
-    db = SessionLocal()
     try:
-        query = text("SELECT * FROM users WHERE name = :name")
-        result = db.execute(query, {"name": name}).fetchone()
-        
-        if not result:
-            raise HTTPException(status_code=404, detail="User not found")
+        async with db.begin():
+            result = await db.execute(DELETE_USER, {"name": name})
         
-        delete_query = text("DELETE FROM users WHERE name = :name")
-        db.execute(delete_query, {"name": name})
-        db.commit()
+            if result.fetchone() is None:
+                raise HTTPException(status_code=404, detail="User not found")
+            await db.execute(BUMP_USERS_VERSION)
+        invalidate_avg_age_cache()
 
-        logging.info(f"User '{name}' deleted successfully")
-        return {"detail": f"User '{name}' deleted"}
+        logger.info("User '%s' deleted successfully", name)
+        return Response(status_code=204)
     
     except HTTPException as http_exc:
         # Specific exception handling for HTTPException
-        logging.error(f"HTTPException: {str(http_exc.detail)}")
+        logger.error("HTTPException: %s", http_exc.detail)
         raise http_exc  # Re-raise the HTTPException to preserve the status code
     
     except Exception as e:
-        logging.error(f"Error deleting user '{name}': {str(e)}")
+        logger.error("Error deleting user '%s': %s", name, e)
         raise HTTPException(status_code=500, detail="Internal server error")
-    
-    finally:
-        db.close()
 
 @app.get("/users/")
-def get_users():
+async def get_users(request: Request, db: AsyncSession = Depends(get_db)):
     """
     Get a list of all users.
     
     Returns:
-    - A list of all users.
+    - A list of all users, with an ETag header identifying the current user table version.
+    - An empty 304 Not Modified response if the If-None-Match header matches that ETag or is "*".
     """
-    db = SessionLocal()
     try:
-        query = text("SELECT * FROM users")
-        result = db.execute(query).fetchall()
-        
-        users = [dict(row) for row in result]
+        # Every write bumps users_version in its own transaction; read it before the rows themselves
+        version = (await db.execute(SELECT_USERS_VERSION)).scalar() or 0
+        etag = f'W/"{version}"'
 
-        logging.info("Retrieved all users successfully")
-        return users
+        # If-None-Match uses weak comparison, so ignore W/ prefixes on both sides
+        client_tags = {tag.strip().removeprefix("W/") for tag in request.headers.get("if-none-match", "").split(",")}
+        if "*" in client_tags or etag.removeprefix("W/") in client_tags:
+            return Response(status_code=304, headers={"ETag": etag})
+
+        users = (await db.execute(SELECT_ALL_USERS)).mappings().all()
+
+        logger.info("Retrieved all users successfully")
+        return ORJSONResponse([dict(user) for user in users], headers={"ETag": etag})  # Skip the jsonable_encoder pass
     
     except Exception as e:
-        logging.error(f"Error retrieving users: {str(e)}")
+        logger.error("Error retrieving users: %s", e)
         raise HTTPException(status_code=500, detail="Internal server error")
-    
-    finally:
-        db.close()
+
+def read_users_csv(file):
+    """Stream (name, age) records from a CSV file object; utf-8-sig drops a leading BOM."""
+    reader = csv.DictReader(io.TextIOWrapper(file, encoding='utf-8-sig'))
+    records = []
+    for row in reader:
+        try:
+            records.append((row['Name'], int(row['Age'])))
+        except (TypeError, ValueError):
+            continue  # Skip rows with a missing or non-numeric age
+    return records
 
 @app.post("/users/upload/")
-def upload_users(file: UploadFile = File(...)):
+async def upload_users(file: UploadFile = File(...), db: AsyncSession = Depends(get_db)):
     """
     Bulk upload users from a CSV file.
     
+    Rows with an empty name, a missing or non-numeric age, or an age greater
+    than 120 are skipped, matching the validation in create_user.
+    
     Args:
     - file: UploadFile - The CSV file containing user data.
     
     Returns:
     - A detail message about the upload status.
     """
-    db = SessionLocal()
     try:
-        csv_data = pd.read_csv(file.file)
-
-        for index, row in csv_data.iterrows():
-            name = row['Name']
-            age = row['Age']
-
-            query = f"SELECT 1 FROM users WHERE name = '{name}'"
-            result = db.execute(query).fetchone()
+        # Parse the spooled upload in the threadpool so file reads and parsing do not block the event loop
+        records = await run_in_threadpool(read_users_csv, file.file)
 
-            if not result:
-                insert_query = f"INSERT INTO users (name, age) VALUES ('{name}', {age})"
-                db.execute(insert_query)
-        
-        db.commit()
+        # COPY rows into a staging table, then merge the valid ones skipping users that already exist
+        if records:
+            async with db.begin():
+                await db.execute(CREATE_USERS_STAGE)
+                raw_conn = await (await db.connection()).get_raw_connection()
+                await raw_conn.driver_connection.copy_records_to_table(
+                    'users_stage', records=records, columns=['name', 'age']
+                )
+                result = await db.execute(MERGE_USERS_STAGE)
+                if result.rowcount:
+                    await db.execute(BUMP_USERS_VERSION)
+            invalidate_avg_age_cache()
 
-        logging.info("Users from CSV uploaded successfully")
+        logger.info("Users from CSV uploaded successfully")
         return {"detail": "Users from CSV uploaded successfully"}
     
     except Exception as e:
-        logging.error(f"Error uploading users from CSV: {str(e)}")
+        logger.error("Error uploading users from CSV: %s", e)
         raise HTTPException(status_code=500, detail="Internal server error")
-    
-    finally:
-        db.close()
 
 @app.get("/users/average_age/")
-def get_average_age_by_group():
+async def get_average_age_by_group(db: AsyncSession = Depends(get_db)):
     """
     Get the average age of users grouped by the first letter of their name.
     
@@ -209,31 +286,30 @@ def get_average_age_by_group():
     Raises:
     - HTTPException: 404 if no users are found.
     """
-    db = SessionLocal()
     try:
-        query = text("SELECT name, age FROM users")
-        result = db.execute(query).fetchall()
-        
-        if not result:
-            raise HTTPException(status_code=404, detail="No users found")
-        
-        user_data = [{"name": row['name'], "age": row['age']} for row in result]
-        df = pd.DataFrame(user_data)
-        
-        df['group'] = df['name'].str[0].str.upper()  # Extract first letter and convert to uppercase
-        avg_age_by_group = df.groupby('group')['age'].mean().to_dict()
+        avg_age_by_group = avg_age_cache.get("avg_age_by_group")
 
-        logging.info("Average age by group retrieved successfully")
+        if avg_age_by_group is None:
+            generation = avg_age_generation
+            # Group by the uppercased first letter of the name inside Postgres
+            result = (await db.execute(SELECT_AVERAGE_AGE_BY_GROUP)).fetchall()
+            
+            if not result:
+                raise HTTPException(status_code=404, detail="No users found")
+            
+            avg_age_by_group = {row.grp: row.avg_age for row in result}
+            # Only cache the result if no write was committed while the query ran
+            if generation == avg_age_generation:
+                avg_age_cache["avg_age_by_group"] = avg_age_by_group
+
+        logger.info("Average age by group retrieved successfully")
         return avg_age_by_group
     
     except HTTPException as http_exc:
         # Specific exception handling for HTTPException
-        logging.error(f"HTTPException: {str(http_exc.detail)}")
+        logger.error("HTTPException: %s", http_exc.detail)
         raise http_exc  # Re-raise the HTTPException to preserve the status code
     
     except Exception as e:
-        logging.error(f"Error calculating average age by group: {str(e)}")
+        logger.error("Error calculating average age by group: %s", e)
         raise HTTPException(status_code=500, detail="Internal server error")
-    
-    finally:
-        db.close()
@@ -1,6 +1,11 @@
+import os
 import unittest
+import uuid
 from fastapi.testclient import TestClient
-from main import app  # Import the FastAPI application instance from the main module
+from sqlalchemy import text
+
+os.environ.setdefault("INIT_DB", "1")  # Let the app create the users table for the database-backed tests
+from main import app, engine  # Import the FastAPI application instance from the main module
 
 client = TestClient(app)  # Create an instance of TestClient for making requests to the FastAPI app
 
@@ -31,5 +36,192 @@ class TestCreateUserAPI(unittest.TestCase):
         self.assertEqual(response.status_code, 400)
         self.assertEqual(response.json(), {"detail": "User age cannot exceed 120 years"})
 
+class DatabaseTestCase(unittest.TestCase):
+    """
+    Base class for tests that talk to the database.
+    
+    The TestClient is entered as a context manager so the app lifespan runs
+    and all requests share one event loop with the async connection pool.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.client = TestClient(app)
+        cls.client.__enter__()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.client.__exit__(None, None, None)
+
+    def unique_name(self):
+        """Return a user name that does not clash with existing rows, deleted after the test."""
+        name = f"test-{uuid.uuid4().hex[:12]}"
+        self.addCleanup(self.client.delete, f"/users/{name}")
+        return name
+
+class TestCreateUserDatabaseAPI(DatabaseTestCase):
+    """
+    Unit tests for the FastAPI create_user endpoint that need the database.
+    """
+
+    def test_create_user_already_exists(self):
+        """
+        Test case for creating the same user twice.
+        
+        This test checks if the API correctly responds with a 400 status code and
+        an appropriate error message when the user name is already taken.
+        """
+        name = self.unique_name()
+
+        response = self.client.post("/users/", json={"name": name, "age": 30})
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.post("/users/", json={"name": name, "age": 31})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {"detail": "User already exists"})
+
+class TestDeleteUserAPI(DatabaseTestCase):
+    """
+    Unit tests for the FastAPI delete_user endpoint.
+    """
+
+    def test_delete_user_returns_no_content(self):
+        """
+        Test case for deleting an existing user and then deleting it again.
+        
+        This test checks if the API responds with a 204 status code and an empty
+        body on success, and with a 404 status code once the user is gone.
+        """
+        name = self.unique_name()
+        self.client.post("/users/", json={"name": name, "age": 30})
+
+        response = self.client.delete(f"/users/{name}")
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(response.content, b"")
+
+        response = self.client.delete(f"/users/{name}")
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json(), {"detail": "User not found"})
+
+class TestUploadUsersAPI(DatabaseTestCase):
+    """
+    Unit tests for the FastAPI upload_users endpoint.
+    """
+
+    def test_upload_users_skips_invalid_and_duplicate_rows(self):
+        """
+        Test case for a CSV upload mixing valid, invalid and duplicate rows.
+        
+        This test checks if only the first occurrence of a valid user is stored,
+        while rows with an age over 120, an empty name, a blank or missing age,
+        or a repeated name are skipped.
+        """
+        valid_name = self.unique_name()
+        over_age_name = self.unique_name()
+        blank_age_name = self.unique_name()
+        missing_age_name = self.unique_name()
+        csv_content = (
+            "Name,Age\n"
+            f"{valid_name},30\n"
+            f"{over_age_name},150\n"
+            ",20\n"
+            f"{blank_age_name},\n"
+            f"{missing_age_name}\n"
+            f"{valid_name},40\n"
+        )
+
+        response = self.client.post(
+            "/users/upload/", files={"file": ("users.csv", csv_content.encode(), "text/csv")}
+        )
+        self.assertEqual(response.status_code, 200)
+
+        users = self.client.get("/users/").json()
+        candidates = (valid_name, over_age_name, blank_age_name, missing_age_name, "")
+        uploaded = [(user["name"], user["age"]) for user in users if user["name"] in candidates]
+        self.assertEqual(uploaded, [(valid_name, 30)])
+
+class TestGetUsersETag(DatabaseTestCase):
+    """
+    Unit tests for ETag handling in the FastAPI get_users endpoint.
+    """
+
+    def test_get_users_returns_etag(self):
+        """
+        Test case for a plain request to the get_users API.
+        
+        This test checks if the API responds with a 200 status code and an ETag header.
+        """
+        response = self.client.get("/users/")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("etag", response.headers)
+
+    def test_get_users_not_modified(self):
+        """
+        Test case for repeating a get_users request with If-None-Match.
+        
+        This test checks if the API responds with a 304 status code and an empty body
+        for the returned ETag, for the same ETag without the W/ prefix, and for "*".
+        """
+        etag = self.client.get("/users/").headers["etag"]
+
+        for if_none_match in (etag, etag.removeprefix("W/"), "*"):
+            response = self.client.get("/users/", headers={"If-None-Match": if_none_match})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.content, b"")
+
+    def test_get_users_etag_changes_after_writes(self):
+        """
+        Test case for reusing an ETag after a user is created and then deleted.
+        
+        This test checks if the API responds with a 200 status code and a new ETag
+        after each write, instead of reporting the stale list as not modified.
+        """
+        name = self.unique_name()
+        etag = self.client.get("/users/").headers["etag"]
+
+        self.client.post("/users/", json={"name": name, "age": 30})
+        response = self.client.get("/users/", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["etag"], etag)
+        etag = response.headers["etag"]
+
+        self.client.delete(f"/users/{name}")
+        response = self.client.get("/users/", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["etag"], etag)
+
+    def test_get_users_etag_changes_when_count_and_max_id_do_not(self):
+        """
+        Test case for a delete plus a late-committed insert of a lower id.
+        
+        This test checks if the API responds with a 200 status code and a new ETag
+        when the row count and the highest id are both unchanged, as happens when
+        concurrent creates commit out of id order.
+        """
+        lower_name = self.unique_name()
+        higher_name = self.unique_name()
+        late_name = self.unique_name()
+        self.client.post("/users/", json={"name": lower_name, "age": 30})
+        self.client.post("/users/", json={"name": higher_name, "age": 30})
+        response = self.client.get("/users/")
+        users = {user["name"]: user["id"] for user in response.json()}
+        etag = response.headers["etag"]
+
+        async def insert_late_user():
+            # Reuse the deleted lower id, as a transaction that took it earlier would commit it
+            async with engine.begin() as conn:
+                await conn.execute(
+                    text("INSERT INTO users (id, name, age) VALUES (:id, :name, 30)"),
+                    {"id": users[lower_name], "name": late_name},
+                )
+
+        self.client.delete(f"/users/{lower_name}")
+        self.client.portal.call(insert_late_user)
+
+        response = self.client.get("/users/", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["etag"], etag)
+        self.assertIn(late_name, [user["name"] for user in response.json()])
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file